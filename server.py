@@ -1,10 +1,13 @@
-import os, re, json, base64, time, asyncio
-from typing import Dict, List, Optional, Any
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+import os, re, json, time, asyncio
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Dict, List, Optional, Any, Tuple
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import BaseModel, ValidationError
 import httpx
-
-app = FastAPI()
+import orjson
+import pybase64
 
 # ===== ENV =====
 SECRET = os.getenv("SECRET", "")
@@ -12,6 +15,7 @@ GITHUB_TOKEN = os.getenv("GITHUB_TOKEN", "")
 GITHUB_USERNAME = os.getenv("GITHUB_USERNAME", "")
 LLM_URL = (os.getenv("LLM_URL") or "").strip()           # e.g. https://aipipe.org/openrouter/v1
 LLM_AUTH = (os.getenv("LLM_AUTH") or "").strip()         # e.g. Bearer AIPIPE_TOKEN
+MAX_CONCURRENT_DEPLOYS = int(os.getenv("MAX_CONCURRENT_DEPLOYS", "32"))  # per worker
 GITHUB_API = "https://api.github.com"
 
 # ===== MODELS =====
@@ -28,7 +32,7 @@ class TaskPayload(BaseModel):
     brief: str
     checks: List[str]
     evaluation_url: str
-    attachments: List[Attachment] = []
+    # attachments are read from the raw body (see read_task): their data URIs can be many MB
 
 # ===== CONSTANTS =====
 MIT_LICENSE = """MIT License
@@ -97,55 +101,177 @@ jobs:
         uses: actions/deploy-pages@v4
 """
 
-DATA_URI_RE = re.compile(r"^data:([\w/.\+\-]+);base64,(.*)$", re.IGNORECASE)
+BLOB_CONCURRENCY = 8
+PAGES_POLL_MAX_S = 8
+WORKFLOW_POLL_S = 3  # actions/runs is a GitHub API call (rate limited), so poll it gently
+PAGES_DEPLOY_BUDGET_S = 180  # workflow wait + Pages probe, per deploy
+PAGES_PROBE_MIN_S = 15  # CDN settle time left to the probe even when the workflow used the budget
+B64_DECODE_CHUNK = 1 << 20  # multiple of 4, so chunks split on whole base64 quanta
+# per-upstream request timeouts (seconds)
+HTTP_TIMEOUTS = {"github": 60.0, "llm": 120.0, "probe": 15.0, "notify": 30.0}
+DECODE_OFFLOAD_MIN = 64 * 1024  # base64 chars; below this a thread hop costs more than the decode
+ENCODE_OFFLOAD_MIN = 48 * 1024  # raw bytes (~64K base64 chars), same trade-off for blob uploads
+BODY_READ_TIMEOUT_S = 30  # a client can't keep a request open by trickling its body
+PATCHER_ASSET_MAX = 32 * 1024  # bytes; bigger assets (images, fonts) aren't fetched as patcher context
+
+# caps in-flight /api-task pipelines (decode through commit) per worker process
+DEPLOY_SEM = asyncio.Semaphore(MAX_CONCURRENT_DEPLOYS)
+
+# ===== Shared HTTP clients =====
+# One pooled client per upstream so keep-alive connections (and their TLS
+# sessions) survive across calls instead of being torn down per request.
+# Created and closed by the app lifespan below.
+GH_CLIENT: Optional[httpx.AsyncClient] = None     # api.github.com
+LLM_CLIENT: Optional[httpx.AsyncClient] = None    # LLM_URL
+PROBE_CLIENT: Optional[httpx.AsyncClient] = None  # GitHub Pages liveness probe
+EVAL_CLIENT: Optional[httpx.AsyncClient] = None   # evaluation callback
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global GH_CLIENT, LLM_CLIENT, PROBE_CLIENT, EVAL_CLIENT
+    # load the CA bundle once and share the context (and its TLS session cache) across clients
+    ssl_ctx = httpx.create_ssl_context()
+    # HTTP/2 (needs the httpx[http2] extra) multiplexes the concurrent blob uploads on one connection;
+    # a single host only needs a few connections, kept warm between deploys
+    GH_CLIENT = httpx.AsyncClient(
+        base_url=GITHUB_API, http2=True, timeout=HTTP_TIMEOUTS["github"], verify=ssl_ctx,
+        limits=httpx.Limits(max_connections=8, max_keepalive_connections=8, keepalive_expiry=300),
+        headers={"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept": "application/vnd.github+json",
+                 "Content-Type": "application/json"},
+    )
+    # fixed per-upstream headers live on the clients, so call sites don't rebuild them
+    LLM_CLIENT = httpx.AsyncClient(timeout=HTTP_TIMEOUTS["llm"], verify=ssl_ctx,
+                                   headers={"Authorization": LLM_AUTH, "Content-Type": "application/json"})
+    # Pages may redirect (e.g. custom domains); only the final status counts
+    PROBE_CLIENT = httpx.AsyncClient(timeout=HTTP_TIMEOUTS["probe"], follow_redirects=True, verify=ssl_ctx,
+                                     headers={"Cache-Control": "no-cache"})
+    EVAL_CLIENT = httpx.AsyncClient(timeout=HTTP_TIMEOUTS["notify"], verify=ssl_ctx,
+                                    headers={"Content-Type": "application/json"})
+    try:
+        yield
+    finally:
+        for client in (GH_CLIENT, LLM_CLIENT, PROBE_CLIENT, EVAL_CLIENT):
+            await client.aclose()
+
+app = FastAPI(lifespan=lifespan)
 
 # ===== HTTP/GitHub helpers =====
 async def gh(method: str, url: str, json_body=None, content=None, extra_headers=None) -> httpx.Response:
-    headers = {"Authorization": f"Bearer {GITHUB_TOKEN}", "Accept": "application/vnd.github+json"}
-    if extra_headers:
-        headers.update(extra_headers)
-    async with httpx.AsyncClient(timeout=60) as client:
-        return await client.request(method, url, json=json_body, headers=headers, content=content)
+    if json_body is not None:
+        # orjson: blob uploads carry large base64 strings, and it yields bytes httpx can send as-is
+        content = orjson.dumps(json_body)
+    return await GH_CLIENT.request(method, url, content=content, headers=extra_headers)
+
+def gh_result(r: httpx.Response) -> Any:
+    # single place that turns a failed GitHub call the deploy depends on into an HTTP error
+    if r.is_error:
+        raise HTTPException(status_code=502,
+                            detail=f"GitHub {r.request.method} {r.request.url.path} -> {r.status_code}: {r.text[:300]}")
+    return r.json()
+
+async def gh_json(method: str, url: str, json_body=None) -> Any:
+    return gh_result(await gh(method, url, json_body=json_body))
 
 def b64e(b: bytes) -> str:
-    return base64.b64encode(b).decode()
-
-def parse_attachments(attachments: List[Attachment]) -> Dict[str, bytes]:
-    out: Dict[str, bytes] = {}
-    for a in attachments:
-        m = DATA_URI_RE.match(a.url)
-        if not m:
-            raise ValueError(f"Attachment {a.name} is not a base64 data URI")
-        out[a.name] = base64.b64decode(m.group(2))
-    return out
+    return pybase64.b64encode_as_string(b)
+
+def b64d_tail(s: str, start: int) -> bytes:
+    # decode s[start:] without materializing an ASCII copy of the whole payload: large payloads
+    # are decoded chunk by chunk into one preallocated buffer
+    n = len(s) - start
+    if n <= B64_DECODE_CHUNK or n % 4:
+        return pybase64.b64decode(memoryview(s.encode("ascii"))[start:], validate=False)
+    out = bytearray(n // 4 * 3)
+    pos = 0
+    try:
+        for i in range(start, len(s), B64_DECODE_CHUNK):
+            # strict per chunk: whitespace or stray characters would shift the 4-char alignment
+            chunk = pybase64.b64decode(s[i:i + B64_DECODE_CHUNK], validate=True)
+            out[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+    except ValueError:
+        return pybase64.b64decode(memoryview(s.encode("ascii"))[start:], validate=False)
+    del out[pos:]  # trailing padding
+    return bytes(out)  # callers hold Dict[str, bytes]; one copy of the decoded size, not of the payload
+
+@lru_cache(maxsize=4)
+def license_text(year: str, owner: str) -> str:
+    return MIT_LICENSE.format(year=year, owner=owner)
+
+def data_uri_payload_start(url: str, pos: int = 0) -> int:
+    # prefix check + find from `pos`: only the header is sliced, never the payload
+    comma = url.find(",", pos + 5) if url[pos:pos + 5].lower() == "data:" else -1
+    if comma < 0 or not url[pos + 5:comma].lower().endswith(";base64"):
+        return -1
+    return comma + 1
+
+async def parse_attachments(attachments: List[Attachment]) -> Dict[str, bytes]:
+    async def decode(a: Attachment) -> bytes:
+        start = data_uri_payload_start(a.url)
+        if start < 0:
+            raise HTTPException(status_code=422, detail=f"Attachment {a.name} is not a base64 data URI")
+        try:
+            if len(a.url) - start < DECODE_OFFLOAD_MIN:
+                return b64d_tail(a.url, start)
+            # large payloads decode on a worker thread so the event loop keeps serving other requests
+            return await asyncio.to_thread(b64d_tail, a.url, start)
+        except ValueError as e:  # binascii.Error (bad base64), UnicodeEncodeError (non-ASCII payload)
+            raise HTTPException(status_code=422, detail=f"Attachment {a.name} has invalid base64 data: {e}")
+
+    blobs = await asyncio.gather(*(decode(a) for a in attachments))
+    return dict(zip((a.name for a in attachments), blobs))
 
 def decode_possible_data_uri_or_text(val: str) -> bytes:
-    m = DATA_URI_RE.match(val.strip())
-    if m:
-        return base64.b64decode(m.group(2))
+    # skip leading whitespace by offset rather than strip() (a full copy of multi-MB URIs);
+    # trailing whitespace is dropped by b64d_tail's lenient fallback
+    head = val[:64]
+    start = data_uri_payload_start(val, len(head) - len(head.lstrip()))
+    if start >= 0:
+        return b64d_tail(val, start)
     return val.encode("utf-8")
 
-async def ensure_repo(owner: str, repo: str) -> Dict[str, Any]:
-    r = await gh("GET", f"{GITHUB_API}/repos/{owner}/{repo}")
+REPO_CREATE_BODY = {"private": False, "auto_init": True, "description": "Auto-generated by LLM code deployer"}
+
+async def ensure_repo(owner: str, repo: str, create_first: bool = False) -> Dict[str, Any]:
+    # create_first: the repo is most likely new (round 1), so skip the lookup and
+    # only fall back to it when GitHub answers 422 (name already taken)
+    if create_first:
+        r = await gh("POST", "/user/repos", json_body={"name": repo, **REPO_CREATE_BODY})
+        if r.status_code != 422:
+            return gh_result(r)
+    r = await gh("GET", f"/repos/{owner}/{repo}")
     if r.status_code == 404:
-        r = await gh("POST", f"{GITHUB_API}/user/repos", json_body={
-            "name": repo, "private": False, "auto_init": True,
-            "description": "Auto-generated by LLM code deployer"
-        })
-        r.raise_for_status()
-    else:
-        r.raise_for_status()
-    return r.json()
+        return await gh_json("POST", "/user/repos", json_body={"name": repo, **REPO_CREATE_BODY})
+    return gh_result(r)
+
+async def prepare_repo(owner: str, repo: str, create_first: bool = False):
+    await ensure_repo(owner, repo, create_first=create_first)
+    # independent once the repo exists; both are best-effort, so log failures instead of raising
+    for res in await asyncio.gather(
+        ensure_actions_write_permissions(owner, repo),
+        ensure_pages_site(owner, repo, create_first=create_first),
+        return_exceptions=True,
+    ):
+        if isinstance(res, Exception):
+            print("⚠️ Repo setup step failed:", repr(res))
 
 async def ensure_actions_write_permissions(owner: str, repo: str):
-    url = f"{GITHUB_API}/repos/{owner}/{repo}/actions/permissions/workflow"
+    url = f"/repos/{owner}/{repo}/actions/permissions/workflow"
     payload = {"default_workflow_permissions": "write", "can_approve_pull_request_reviews": False}
     r = await gh("PUT", url, json_body=payload)
     if r.status_code not in (200, 204):
         print("⚠️ Could not set workflow write perms:", r.status_code, r.text)
 
-async def ensure_pages_site(owner: str, repo: str):
-    get_url = f"{GITHUB_API}/repos/{owner}/{repo}/pages"
+async def ensure_pages_site(owner: str, repo: str, create_first: bool = False):
+    get_url = f"/repos/{owner}/{repo}/pages"
+    if create_first:
+        # same idea as ensure_repo: a 409 means the site exists, so check its build type below
+        r = await gh("POST", get_url, json_body={"build_type": "workflow"})
+        if r.status_code in (201, 204):
+            return
+        if r.status_code != 409:
+            print("⚠️ Pages create failed:", r.status_code, r.text)
+            return
     r = await gh("GET", get_url)
     if r.status_code == 404:
         r2 = await gh("POST", get_url, json_body={"build_type": "workflow"})
@@ -160,111 +286,200 @@ async def ensure_pages_site(owner: str, repo: str):
     else:
         print("⚠️ Pages GET unexpected:", r.status_code, r.text)
 
-async def batch_commit(owner: str, repo: str, files: Dict[str, bytes], message: str) -> str:
-    # base ref
-    r = await gh("GET", f"{GITHUB_API}/repos/{owner}/{repo}/git/ref/heads/main")
-    r.raise_for_status()
-    base_commit = r.json()["object"]["sha"]
-    r = await gh("GET", f"{GITHUB_API}/repos/{owner}/{repo}/git/commits/{base_commit}")
-    r.raise_for_status()
-    base_tree = r.json()["tree"]["sha"]
-
-    # blobs
-    entries = []
+async def batch_commit(owner: str, repo: str, files: Dict[str, bytes], message: str,
+                       texts: Optional[Dict[str, str]] = None) -> str:
+    """
+    Commit `files` (path => bytes) plus `texts` (path => str) on top of main as a single commit.
+    """
+    # base ref (resolved while the blobs upload; neither depends on the other)
+    async def resolve_base() -> Tuple[str, str]:
+        commit_sha = (await gh_json("GET", f"/repos/{owner}/{repo}/git/ref/heads/main"))["object"]["sha"]
+        commit = await gh_json("GET", f"/repos/{owner}/{repo}/git/commits/{commit_sha}")
+        return commit_sha, commit["tree"]["sha"]
+
+    # text goes inline in the tree POST (GitHub creates those blobs itself);
+    # only binary files need their own blob upload
+    entries: List[Dict[str, str]] = [
+        {"path": p, "mode": "100644", "type": "blob", "content": t} for p, t in (texts or {}).items()
+    ]
+    binaries: Dict[str, bytes] = {}
     for path, blob in files.items():
-        rb = await gh("POST", f"{GITHUB_API}/repos/{owner}/{repo}/git/blobs",
-                      json_body={"content": b64e(blob), "encoding": "base64"})
-        rb.raise_for_status()
-        entries.append({"path": path, "mode": "100644", "type": "blob", "sha": rb.json()["sha"]})
+        try:
+            entries.append({"path": path, "mode": "100644", "type": "blob", "content": blob.decode("utf-8")})
+        except UnicodeDecodeError:
+            binaries[path] = blob
+
+    # blobs (disjoint paths, so upload concurrently; bounded to stay clear of secondary rate limits)
+    sem = asyncio.Semaphore(BLOB_CONCURRENCY)
+
+    def blob_body(blob: bytes) -> bytes:
+        return orjson.dumps({"content": b64e(blob), "encoding": "base64"})
+
+    async def create_blob(path: str, blob: bytes) -> Dict[str, str]:
+        async with sem:
+            # large images: encode + serialize off the loop so other deploys keep being served
+            body = blob_body(blob) if len(blob) < ENCODE_OFFLOAD_MIN else await asyncio.to_thread(blob_body, blob)
+            rb = gh_result(await gh("POST", f"/repos/{owner}/{repo}/git/blobs", content=body))
+        return {"path": path, "mode": "100644", "type": "blob", "sha": rb["sha"]}
+
+    (base_commit, base_tree), *blob_entries = await asyncio.gather(
+        resolve_base(), *(create_blob(p, b) for p, b in binaries.items())
+    )
+    entries.extend(blob_entries)
 
     # tree
-    rt = await gh("POST", f"{GITHUB_API}/repos/{owner}/{repo}/git/trees",
-                  json_body={"base_tree": base_tree, "tree": entries})
-    rt.raise_for_status()
-    new_tree = rt.json()["sha"]
+    new_tree = (await gh_json("POST", f"/repos/{owner}/{repo}/git/trees",
+                              json_body={"base_tree": base_tree, "tree": entries}))["sha"]
 
     # commit
-    rc = await gh("POST", f"{GITHUB_API}/repos/{owner}/{repo}/git/commits",
-                  json_body={"message": message, "tree": new_tree, "parents": [base_commit]})
-    rc.raise_for_status()
-    new_commit = rc.json()["sha"]
+    new_commit = (await gh_json("POST", f"/repos/{owner}/{repo}/git/commits",
+                                json_body={"message": message, "tree": new_tree, "parents": [base_commit]}))["sha"]
 
     # update ref
-    rr = await gh("PATCH", f"{GITHUB_API}/repos/{owner}/{repo}/git/refs/heads/main",
+    await gh_json("PATCH", f"/repos/{owner}/{repo}/git/refs/heads/main",
                   json_body={"sha": new_commit, "force": True})
-    rr.raise_for_status()
     return new_commit
 
-async def fetch_repo_files(owner: str, repo: str, paths: List[str]) -> Dict[str, bytes]:
+async def repo_tree_blobs(owner: str, repo: str) -> Dict[str, Tuple[str, int]]:
     """
-    Fetch a set of files (if they exist) from the repo@main.
+    Map every file on main to its (blob sha, size) with a single recursive tree read.
     """
-    out: Dict[str, bytes] = {}
-    for p in paths:
-        r = await gh("GET", f"{GITHUB_API}/repos/{owner}/{repo}/contents/{p}?ref=main")
+    r = await gh("GET", f"/repos/{owner}/{repo}/git/trees/main?recursive=1")
+    if r.status_code != 200:
+        return {}
+    return {e["path"]: (e["sha"], e.get("size", 0)) for e in r.json().get("tree", []) if e.get("type") == "blob"}
+
+async def fetch_repo_files(owner: str, repo: str, shas: Dict[str, str]) -> Dict[str, bytes]:
+    """
+    Fetch a set of files (path => blob sha, see repo_tree_blobs) from the repo, in the given order.
+    """
+    sem = asyncio.Semaphore(BLOB_CONCURRENCY)
+
+    async def fetch_blob(sha: str) -> Optional[bytes]:
+        async with sem:
+            r = await gh("GET", f"/repos/{owner}/{repo}/git/blobs/{sha}")
         if r.status_code == 200:
             j = r.json()
-            if isinstance(j, dict) and j.get("encoding") == "base64" and "content" in j:
-                out[p] = base64.b64decode(j["content"])
-    return out
+            if j.get("encoding") == "base64" and "content" in j:
+                return pybase64.b64decode(j["content"], validate=False)
+        return None
 
-async def list_assets(owner: str, repo: str) -> List[str]:
-    # best-effort: list assets/ dir
-    r = await gh("GET", f"{GITHUB_API}/repos/{owner}/{repo}/contents/assets?ref=main")
-    paths: List[str] = []
-    if r.status_code == 200 and isinstance(r.json(), list):
-        for item in r.json():
-            if item.get("type") == "file" and item.get("path", "").startswith("assets/"):
-                paths.append(item["path"])
-    return paths
+    blobs = await asyncio.gather(*(fetch_blob(sha) for sha in shas.values()))
+    return {p: b for p, b in zip(shas, blobs) if b is not None}
 
 async def wait_for_200(url: str, timeout_s: int = 180) -> bool:
-    start = time.time()
-    async with httpx.AsyncClient(timeout=15) as client:
-        last = None
-        while time.time() - start < timeout_s:
+    # HEAD only needs the status line; poll quickly at first, then back off to PAGES_POLL_MAX_S.
+    # wait_for owns the deadline, so it also cuts off an in-flight probe and passes cancellation through
+    last = None
+
+    async def probe() -> bool:
+        nonlocal last
+        try:
+            r = await PROBE_CLIENT.head(url)
+            last = r.status_code
+            return r.status_code == 200
+        except Exception:
+            return False
+
+    async def poll():
+        delay = 1.0
+        while True:
+            # the interval runs alongside the probe rather than after it, so a slow HEAD
+            # doesn't stretch the cadence; a 200 returns at once without waiting out the tick
+            tick = asyncio.ensure_future(asyncio.sleep(delay))
             try:
-                r = await client.get(url, headers={"Cache-Control": "no-cache"})
-                last = r.status_code
-                if r.status_code == 200:
-                    return True
-            except Exception:
-                pass
-            await asyncio.sleep(3)
-    print(f"⚠️ Pages not 200 within {timeout_s}s (last={last})")
-    return False
+                if await probe():
+                    return
+                await tick
+            finally:
+                tick.cancel()
+            delay = min(delay * 1.5, PAGES_POLL_MAX_S)
 
-async def post_with_backoff(url: str, payload: dict, max_tries: int = 8) -> bool:
+    try:
+        await asyncio.wait_for(poll(), timeout=timeout_s)
+        return True
+    except asyncio.TimeoutError:
+        print(f"⚠️ Pages not 200 within {timeout_s}s (last={last})")
+        return False
+
+async def wait_for_workflow(owner: str, repo: str, head_sha: str,
+                            timeout_s: int = 180, appear_s: int = 20) -> Optional[str]:
+    """
+    Wait for the Pages workflow run of `head_sha` to complete; returns its conclusion.
+    None when no run shows up within `appear_s` (the paths filter can skip it);
+    "timed_out" (as GitHub reports a run that ran too long) when a run was seen but
+    didn't complete within `timeout_s`.
+    """
+    url = f"/repos/{owner}/{repo}/actions/runs?head_sha={head_sha}&per_page=1"
+    start = time.monotonic()
+    seen = False
+    while True:
+        try:
+            r = await gh("GET", url)
+            runs = r.json().get("workflow_runs") if r.status_code == 200 else None
+            if runs:
+                seen = True
+                if runs[0].get("status") == "completed":
+                    return runs[0].get("conclusion")
+        except Exception:
+            pass
+        elapsed = time.monotonic() - start
+        if not seen and elapsed >= appear_s:
+            return None
+        if elapsed >= timeout_s:
+            return "timed_out"
+        await asyncio.sleep(WORKFLOW_POLL_S)
+
+async def post_with_backoff(url: str, content: bytes, max_tries: int = 8) -> bool:
+    # content is the already-serialized JSON body, sent as-is on every attempt
     delay = 1
-    async with httpx.AsyncClient(timeout=30) as client:
-        for _ in range(max_tries):
-            try:
-                r = await client.post(url, json=payload, headers={"Content-Type": "application/json"})
-                if r.status_code == 200:
-                    return True
-            except Exception:
-                pass
+    for attempt in range(max_tries):
+        try:
+            r = await EVAL_CLIENT.post(url, content=content)
+            if r.status_code == 200:
+                return True
+        except Exception:
+            pass
+        if attempt < max_tries - 1:  # nothing left to wait for after the last attempt
             await asyncio.sleep(delay)
             delay *= 2
+    print(f"⚠️ Evaluation callback failed after {max_tries} attempts")
     return False
 
+async def finalize_deploy(owner: str, repo: str, pages_url: str, evaluation_url: str, resp: dict):
+    # runs after the response is sent, so the request doesn't sit on the Pages rollout.
+    # the workflow run says when the deploy is done; the HEAD probe then only confirms the CDN
+    deadline = time.monotonic() + PAGES_DEPLOY_BUDGET_S
+    conclusion = await wait_for_workflow(owner, repo, resp["commit_sha"], timeout_s=PAGES_DEPLOY_BUDGET_S)
+    if conclusion not in (None, "success"):
+        # nothing new is being served (failed, or still running at the deadline): round 1 would
+        # never 200, round 2 would 200 on the previous deploy
+        print(f"⚠️ Pages workflow for {repo}@{resp['commit_sha'][:7]} concluded {conclusion}; skipping probe")
+    else:
+        await wait_for_200(pages_url, timeout_s=max(deadline - time.monotonic(), PAGES_PROBE_MIN_S))
+    await post_with_backoff(evaluation_url, orjson.dumps(resp))
+
 # ===== LLM helpers =====
 def _llm_endpoint(path: str) -> str:
     return LLM_URL.rstrip("/") + path
 
+def files_from_llm(obj: Optional[dict]) -> Optional[Dict[str, bytes]]:
+    # {"files": {path: text or data URI}} -> path => bytes, decoded in a single pass
+    if isinstance(obj, dict) and isinstance(obj.get("files"), dict):
+        return {k: decode_possible_data_uri_or_text(str(v)) for k, v in obj["files"].items()}
+    return None
+
 async def llm_chat_json(messages: List[Dict[str, str]], model: str = "google/gemini-2.0-flash-lite-001") -> Optional[dict]:
     if not (LLM_URL and LLM_AUTH):
         return None
-    headers = {"Authorization": LLM_AUTH, "Content-Type": "application/json"}
     body = {"model": model, "messages": messages, "temperature": 0.2, "response_format": {"type": "json_object"}}
     url = _llm_endpoint("/chat/completions")
     try:
-        async with httpx.AsyncClient(timeout=120) as client:
-            r = await client.post(url, headers=headers, json=body)
-            r.raise_for_status()
-            data = r.json()
-            content = data.get("choices", [{}])[0].get("message", {}).get("content", "{}")
-            return json.loads(content)
+        r = await LLM_CLIENT.post(url, content=orjson.dumps(body))
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+        content = data.get("choices", [{}])[0].get("message", {}).get("content", "{}")
+        return orjson.loads(content)
     except Exception as e:
         print("LLM error:", repr(e))
         return None
@@ -533,48 +748,132 @@ def generic_files(brief: str) -> Dict[str, bytes]:
         "styles.css": b"body{font-family:system-ui,Segoe UI,Roboto,Helvetica,Arial,sans-serif}",
     }
 
+# the sales templates are brief-independent: build their bytes once
+SALES_ROUND1_FILES = sales_round1_files()
+SALES_ROUND2_FILES = sales_round2_files()
+SALES_ROUND1_IDS = frozenset(re.findall(r'id="([^"]+)"', SALES_ROUND1_FILES["index.html"].decode()))
+SELECTOR_ID_RE = re.compile(r"#([A-Za-z][\w-]*)")
+
+@lru_cache(maxsize=256)
+def _classify_brief(brief_lower: str) -> str:
+    if "sum-of-sales" in brief_lower or ("sales" in brief_lower and "csv" in brief_lower):
+        return "sales"
+    return "generic"
+
+def template_only(brief: str, checks: List[str], round_i: int, att_bytes: Dict[str, bytes]) -> bool:
+    # the round-1 sales template is shipped as-is only when it is known to satisfy the request:
+    # the sum-of-sales task, an attached product,sales CSV (its script reads exactly those two
+    # columns) and no element id in the brief or checks beyond the ones it renders.
+    # Anything else goes to the LLM and keeps the template as its fallback
+    if round_i > 1 or "sum-of-sales" not in brief.lower():
+        return False
+    csv = att_bytes.get("data.csv")
+    if csv is None or csv.split(b"\n", 1)[0].strip().lower() != b"product,sales":
+        return False
+    return set(SELECTOR_ID_RE.findall(" ".join([brief, *checks]))) <= SALES_ROUND1_IDS
+
 def choose_template(brief: str, round_i: int) -> Dict[str, bytes]:
-    b = brief.lower()
-    if "sum-of-sales" in b or ("sales" in b and "csv" in b):
-        return sales_round2_files() if round_i >= 2 else sales_round1_files()
+    if _classify_brief(brief.lower()) == "sales":
+        # copy: callers add attachments to the returned map
+        return dict(SALES_ROUND2_FILES if round_i >= 2 else SALES_ROUND1_FILES)
     return generic_files(brief)
 
 # ===== Validators =====
 def ensure_core(files: Dict[str, bytes]) -> bool:
     return {"index.html","script.js","styles.css"}.issubset(files.keys())
 
+def attachments_from_raw(items: Any) -> List[Attachment]:
+    # cheap checks only (shape + data URI header); decoding the (large) payloads is left to parse_attachments
+    if not isinstance(items, list):
+        raise HTTPException(status_code=422, detail="attachments must be a list")
+    out: List[Attachment] = []
+    for i, it in enumerate(items):
+        if not (isinstance(it, dict) and isinstance(it.get("name"), str) and isinstance(it.get("url"), str)):
+            raise HTTPException(status_code=422, detail=f"attachments[{i}] needs string name and url")
+        if data_uri_payload_start(it["url"]) < 0:
+            raise HTTPException(status_code=422, detail=f"attachments[{i}] ({it['name']}) is not a base64 data URI")
+        out.append(Attachment.model_construct(name=it["name"], url=it["url"]))
+    return out
+
+async def read_task(request: Request) -> Tuple[TaskPayload, List[Attachment]]:
+    try:
+        raw = await request.json()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="body is not valid JSON")
+    if not isinstance(raw, dict):
+        raise HTTPException(status_code=422, detail="body must be a JSON object")
+    attachments = attachments_from_raw(raw.pop("attachments", []))  # only a missing key means none
+    try:
+        body = TaskPayload(**raw)
+    except ValidationError as e:
+        # same error shape FastAPI produces for a declared body model
+        raise RequestValidationError([{**err, "loc": ("body", *err["loc"])} for err in e.errors()])
+    return body, attachments
+
+def task_request_schema() -> Dict[str, Any]:
+    # read_task parses the body by hand, so the request model is declared to OpenAPI explicitly
+    schema = TaskPayload.model_json_schema()
+    schema["properties"]["attachments"] = {
+        "title": "Attachments", "type": "array", "items": Attachment.model_json_schema(), "default": [],
+    }
+    return {"requestBody": {"required": True, "content": {"application/json": {"schema": schema}}}}
+
 # ===== ROUTES =====
 @app.get("/")
 def root():
     return {"status": "ok", "mode": "round-aware (planner/builder; context patcher on round>=2)"}
 
-@app.post("/api-task")
-async def api_task(body: TaskPayload):
+@app.post("/api-task", openapi_extra=task_request_schema())
+async def api_task(request: Request, background_tasks: BackgroundTasks):
+    # body read and auth happen before a deploy slot is taken, so slow or unauthenticated
+    # clients can't hold one; the read itself is time-boxed
+    try:
+        body, attachments = await asyncio.wait_for(read_task(request), timeout=BODY_READ_TIMEOUT_S)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=408, detail="request body not received in time")
     if body.secret != SECRET:
         raise HTTPException(status_code=403, detail="invalid secret")
     if not GITHUB_TOKEN or not GITHUB_USERNAME:
         raise HTTPException(status_code=500, detail="server missing GitHub config")
+    # bursts queue here: a waiting request still holds its parsed body, but no decode
+    # buffers and no upstream calls
+    async with DEPLOY_SEM:
+        return await run_deploy(body, attachments, background_tasks)
 
-    # attachments
-    att_bytes = parse_attachments(body.attachments)
-    att_names = list(att_bytes.keys())
+async def run_deploy(body: TaskPayload, attachments: List[Attachment], background_tasks: BackgroundTasks) -> dict:
+    # attachments (headers were validated in read_task)
+    att_names = list(dict.fromkeys(a.name for a in attachments))
 
     repo_name = body.task.replace("/", "-")
     pages_url = f"https://{GITHUB_USERNAME}.github.io/{repo_name}/"
-    await ensure_repo(GITHUB_USERNAME, repo_name)
-    await ensure_actions_write_permissions(GITHUB_USERNAME, repo_name)
-    await ensure_pages_site(GITHUB_USERNAME, repo_name)
+    # decode first: a bad payload is rejected before any side effect on GitHub
+    # (large decodes run on a worker thread, so the loop isn't held meanwhile)
+    att_bytes = await parse_attachments(attachments)
+    # round 1 is usually a new repo
+    await prepare_repo(GITHUB_USERNAME, repo_name, create_first=body.round <= 1)
 
-    files_text: Optional[Dict[str, str]] = None
+    files: Optional[Dict[str, bytes]] = None
+    # a request the round-1 template fully covers skips the LLM round trips entirely
+    use_llm = bool(LLM_URL and LLM_AUTH) and not template_only(body.brief, body.checks, body.round, att_bytes)
 
     # ===== Round >= 2: context-aware patcher =====
-    if body.round >= 2 and LLM_URL and LLM_AUTH:
-        # fetch current core files + assets + data.*
+    if body.round >= 2 and use_llm:
+        # fetch current core files + assets + data.*; the tree listing lets us skip paths that don't exist.
+        # core files go first so the prompt cap below can only ever cut assets
         core_paths = ["index.html","script.js","styles.css","README.md","data.csv","data.json"]
-        asset_paths = await list_assets(GITHUB_USERNAME, repo_name)
-        current = await fetch_repo_files(GITHUB_USERNAME, repo_name, core_paths + asset_paths)
-        # stringify for LLM
-        current_text_map = {p: current[p].decode("utf-8", errors="replace") for p in current}
+        tree = await repo_tree_blobs(GITHUB_USERNAME, repo_name)
+        wanted = {p: tree[p][0] for p in core_paths if p in tree}
+        wanted.update((p, sha) for p, (sha, size) in tree.items()
+                      if p.startswith("assets/") and size <= PATCHER_ASSET_MAX)
+        current = await fetch_repo_files(GITHUB_USERNAME, repo_name, wanted)
+        # stringify for LLM; binary assets would only be mojibake, so they are left out
+        current_text_map: Dict[str, str] = {}
+        for p, blob in current.items():
+            try:
+                current_text_map[p] = blob.decode("utf-8")
+            except UnicodeDecodeError:
+                if p in core_paths:
+                    current_text_map[p] = blob.decode("utf-8", errors="replace")
         patcher_json = await llm_chat_json(
             [
                 {"role":"system","content":PATCHER_SYSTEM},
@@ -585,11 +884,10 @@ async def api_task(body: TaskPayload):
                 )}
             ]
         )
-        if isinstance(patcher_json, dict) and isinstance(patcher_json.get("files"), dict):
-            files_text = {k: str(v) for k, v in patcher_json["files"].items()}
+        files = files_from_llm(patcher_json)
 
     # ===== Round 1 or fallback: planner -> builder, then single-shot =====
-    if files_text is None and LLM_URL and LLM_AUTH:
+    if files is None and use_llm:
         planner_json = await llm_chat_json(
             [{"role":"system","content":PLANNER_SYSTEM},
              {"role":"user","content":PLANNER_USER_TMPL.format(brief=body.brief, attachment_names=att_names)}]
@@ -600,43 +898,33 @@ async def api_task(body: TaskPayload):
                 [{"role":"system","content":BUILDER_SYSTEM},
                  {"role":"user","content":BUILDER_USER_TMPL.format(spec_json=json.dumps(spec))}]
             )
-            if isinstance(built, dict) and isinstance(built.get("files"), dict):
-                files_text = {k: str(v) for k, v in built["files"].items()}
-        if files_text is None:
+            files = files_from_llm(built)
+        if files is None:
             single = await llm_chat_json(
                 [{"role":"system","content":SINGLE_BUILDER_SYSTEM},
                  {"role":"user","content":SINGLE_BUILDER_USER_TMPL.format(brief=body.brief, attachment_names=att_names)}]
             )
-            if isinstance(single, dict) and isinstance(single.get("files"), dict):
-                files_text = {k: str(v) for k, v in single["files"].items()}
-
-    # convert to bytes
-    files: Dict[str, bytes] = {}
-    if files_text:
-        for path, val in files_text.items():
-            files[path] = decode_possible_data_uri_or_text(val)
+            files = files_from_llm(single)
 
     # deterministic fallback
-    if not ensure_core(files):
+    if files is None or not ensure_core(files):
         files = choose_template(body.brief, body.round)
 
     # overwrite attachments
     for name, blob in att_bytes.items():
         files[name] = blob
 
-    # add license, workflow, readme (keep LLM README if provided)
-    all_files: Dict[str, bytes] = {}
-    all_files["LICENSE"] = MIT_LICENSE.format(year=time.strftime("%Y"), owner=GITHUB_USERNAME).encode()
-    default_readme = f"# {repo_name}\n\nTask: `{body.task}` (round {body.round})\n\nBrief:\n\n{body.brief}\n\nPages: {pages_url}\n\nLicense: MIT\n"
-    all_files["README.md"] = files.get("README.md", default_readme.encode())
-    all_files[".github/workflows/pages.yml"] = PAGES_WORKFLOW.encode()
-    for p, b in files.items():
-        if p == "README.md":
-            continue
-        all_files[p] = b
+    # add license, workflow, readme (keep LLM README if provided); these are built as str and go into
+    # the tree in that form, with generated/attached files of the same path taking precedence
+    texts: Dict[str, str] = {
+        "LICENSE": license_text(time.strftime("%Y"), GITHUB_USERNAME),
+        ".github/workflows/pages.yml": PAGES_WORKFLOW,
+        "README.md": f"# {repo_name}\n\nTask: `{body.task}` (round {body.round})\n\nBrief:\n\n{body.brief}\n\nPages: {pages_url}\n\nLicense: MIT\n",
+    }
+    for p in files:
+        texts.pop(p, None)
 
-    commit_sha = await batch_commit(GITHUB_USERNAME, repo_name, all_files, f"[{body.task}] round {body.round} deploy")
-    await wait_for_200(pages_url, timeout_s=180)
+    commit_sha = await batch_commit(GITHUB_USERNAME, repo_name, files, f"[{body.task}] round {body.round} deploy", texts)
 
     resp = {
         "email": body.email,
@@ -647,5 +935,18 @@ async def api_task(body: TaskPayload):
         "commit_sha": commit_sha,
         "pages_url": pages_url,
     }
-    await post_with_backoff(body.evaluation_url, resp)
+    background_tasks.add_task(finalize_deploy, GITHUB_USERNAME, repo_name, pages_url, body.evaluation_url, resp)
     return resp
+
+if __name__ == "__main__":
+    import uvicorn
+    # loop/http "auto" resolve to uvloop + httptools (shipped with uvicorn[standard]) and fall back
+    # to asyncio/h11 where they are unavailable; workers default to 2*CPU+1 unless WEB_CONCURRENCY is set
+    uvicorn.run(
+        "server:app",
+        host=os.getenv("HOST", "0.0.0.0"),
+        port=int(os.getenv("PORT", "8000")),
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("WEB_CONCURRENCY") or 2 * (os.cpu_count() or 1) + 1),
+    )